@@ -4,6 +4,7 @@ Hardclone CLI - Partition Backup Creator/Restorer with Dialog Interface (Python)
 Author: Dawid Bielecki "dawciobiel"
 Version: {VERSION}
 License: GPL-3.0
+Requires: Python 3.8+
 Description:
     Interactive Python script for creating and restoring partition backups with encryption,
     compression, and file splitting.
@@ -14,6 +15,26 @@ import subprocess
 import shutil
 import sys
 import glob
+import errno
+import hashlib
+import zlib
+import itertools
+import collections
+import multiprocessing
+import stat
+import ctypes
+import fcntl
+import struct
+import mmap
+import argparse
+import re
+import string
+import json
+import threading
+import queue
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 import tempfile
 
@@ -27,7 +48,9 @@ def ensure_root():
             sys.exit(e.returncode)
         sys.exit(0)
 
-ensure_root()
+# Re-exec under sudo before anything else runs, compression workers import this as __mp_main__
+if __name__ == "__main__":
+    ensure_root()
 
 try:
     import dialog  # python3-dialog
@@ -37,10 +60,59 @@ except ImportError:
     print("or with package manager: python3-dialog")
     sys.exit(1)
 
+try:
+    import zstandard  # optional, compresses in-process with libzstd threads
+except ImportError:
+    zstandard = None
+
+try:
+    # optional, encrypts in-process through OpenSSL's EVP API (AES-NI)
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+def _version_stale(version_file, git_dir):
+    """Return True if version_file is missing or older than HEAD or the tags of git_dir."""
+    try:
+        mtime = version_file.stat().st_mtime
+    except OSError:
+        return True
+    for ref in (git_dir / "HEAD", git_dir / "refs" / "tags"):
+        try:
+            if ref.stat().st_mtime > mtime:
+                return True
+        except OSError:
+            continue
+    return False
+
 # Load version from external file
+@functools.lru_cache(maxsize=1)
 def get_version():
+    """Return the version from the VERSION file.
+
+    git is only asked (and VERSION rewritten) when the file is missing, older
+    than the checkout's HEAD or tags, or HCLI_REFRESH_VERSION=1 is set, so
+    normal start-up does not fork.
+    """
     version_file = Path(__file__).parent / "VERSION"
+    refresh = os.environ.get("HCLI_REFRESH_VERSION") == "1"
+    if not refresh and not _version_stale(version_file, Path(__file__).parent / ".git"):
+        return version_file.read_text(encoding="utf-8").strip()
+    try:
+        version = subprocess.check_output(
+            ["git", "describe", "--tags", "--abbrev=0"],
+            cwd=Path(__file__).parent, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+        version_file.write_text(version + "\n", encoding="utf-8")
+        return version
+    except (subprocess.CalledProcessError, OSError):
+        pass
     if version_file.exists():
+        # Checked against this HEAD already, do not ask git again on every start
+        try:
+            os.utime(version_file)
+        except OSError:
+            pass  # not ours or read-only, git is asked again next time
         return version_file.read_text(encoding="utf-8").strip()
     return "unknown"
 
@@ -52,140 +124,855 @@ Hardclone CLI - Partition Backup Creator/Restorer with Dialog Interface (Python)
 Author: Dawid Bielecki "dawciobiel"
 Version: {VERSION}
 License: GPL-3.0
+Requires: Python 3.8+
 Description:
     Interactive Python script for creating and restoring partition backups with encryption,
     compression, and file splitting.
 """
 
-d = dialog.Dialog(dialog="dialog")
+# Created by main(), worker processes import this file without running any start-up code
+d = None
 
 # ===============================
-# Global variables
+# Configuration
 # ===============================
-DEVICE = ""
-PARTITION = ""
-OUTPUT_PATH = ""
-ENCRYPT = False
-ENCRYPT_PASSWORD = ""
-COMPRESS = False
-SPLIT = False
-SPLIT_SIZE = ""
-
-RESTORE_FILE = ""
-RESTORE_DEVICE = ""
-RESTORE_PARTITION = ""
-IS_ENCRYPTED = False
-IS_COMPRESSED = False
-IS_SPLIT = False
-RESTORE_PASSWORD = ""
+@dataclass(frozen=True)
+class BackupConfig:
+    """Everything create_image needs for one partition backup."""
+    device: str
+    partition: str
+    output: str
+    encrypt: bool = False
+    password: str = ""
+    compress: bool = False
+    compress_method: str = "zstd"
+    split_size: str = ""  # as typed by the user, empty when not splitting
+    split_bytes: int = 0
+    workers: int = 0  # compression processes for large partitions, 0 = one per core
+    block_size: int = 0  # read size, 0 = optimal_bs() of the partition
+
+@dataclass(frozen=True)
+class RestoreConfig:
+    """Everything restore_image needs, as detected from the image file."""
+    file: str
+    device: str
+    partition: str
+    encrypted: bool = False
+    password: str = ""
+    decompressor: tuple = ()  # argv, empty when the image is not compressed
+    parts: tuple = ()  # split parts in order, empty for a single file
+
+# False when running from command line arguments without dialog
+INTERACTIVE = True
 
 # ===============================
 # Helper functions
 # ===============================
+# (shift, unit, whole) indexed by (bit_length - 1) // 10 - 1, clamped to the table
+_SIZE_UNITS = ((10, "KB", True), (20, "MB", False), (30, "GB", False), (40, "TB", False))
+
+def notify(text):
+    """Show a message box, or print the message in non-interactive mode."""
+    if INTERACTIVE:
+        d.msgbox(text, width=70)
+    else:
+        print(text)
+
 def format_size(bytes_size):
     """Convert bytes to human-readable format."""
     try:
         bytes_size = int(bytes_size)
     except Exception:
         return "Unknown size"
-    if bytes_size >= 1 << 40:
-        return f"{bytes_size / (1 << 40):.1f} TB"
-    elif bytes_size >= 1 << 30:
-        return f"{bytes_size / (1 << 30):.1f} GB"
-    elif bytes_size >= 1 << 20:
-        return f"{bytes_size / (1 << 20):.1f} MB"
+    index = min(max((bytes_size.bit_length() - 1) // 10 - 1, 0), len(_SIZE_UNITS) - 1)
+    shift, unit, whole = _SIZE_UNITS[index]
+    if whole:
+        return f"{bytes_size >> shift} {unit}"
+    return f"{bytes_size / (1 << shift):.1f} {unit}"
+
+# Multipliers for the size suffixes accepted by parse_size
+_SIZE_UNITS_MUL = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+# Ask before creating more split parts than this
+MAX_SPLIT_PARTS = 10000
+
+_SIZE_RE = re.compile(r"(\d*\.?\d+)\s*([KMGT]?)B?", re.I)
+
+def parse_size(text):
+    """Parse a size like 4G, 500M or .5G into bytes. Raises ValueError."""
+    m = _SIZE_RE.fullmatch(text.strip())
+    if not m:
+        raise ValueError(f"Invalid size: {text}")
+    size = int(float(m.group(1)) * _SIZE_UNITS_MUL[m.group(2).upper()])
+    if size <= 0:
+        raise ValueError(f"Invalid size: {text}")
+    return size
+
+def split_suffix_length(total, part_size):
+    """Return the split -a suffix length needed for total bytes in part_size parts."""
+    parts = -(-total // part_size) if total else 0
+    length = 2
+    while 26 ** length < parts:
+        length += 1
+    return length
+
+# Magic bytes at the start of a compressed or encrypted image
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+OPENSSL_MAGIC = b"Salted__"
+
+# openssl enc does not support AEAD modes, CTR lets AES-NI work on blocks in parallel
+CIPHER = "-aes-256-ctr"
+PBKDF2_ITERATIONS = 600000
+# Encrypted ahead of the image data; CTR has no padding check, this block catches a wrong password
+KEY_CHECK_BLOCK = b"HCLI-KEY-CHECK-1"
+# zstd long-distance matching window (2^27 = 128 MiB), finds repeats across a disk image.
+# Still within the default decoder limit, so restore needs no --long flag.
+ZSTD_LONG_WINDOW = 27
+
+def image_size_bound(size, compress=False, encrypt=False):
+    """Return an upper bound on the image written for size bytes of partition."""
+    if compress:
+        # Incompressible data grows by block and frame headers, far less than this
+        size += (size >> 7) + (64 << 10)
+    if encrypt:
+        size += len(OPENSSL_MAGIC) + 8 + len(KEY_CHECK_BLOCK)
+    return size
+
+def pick_compressor(method="zstd"):
+    """Return (argv, extension) for the fastest available compressor.
+
+    zstd is preferred when requested, then the parallel gzip implementation
+    pigz, and plain gzip only when neither is installed.
+    """
+    if method == "zstd" and shutil.which("zstd"):
+        return ["zstd", "-T0", "-3", f"--long={ZSTD_LONG_WINDOW}"], "zst"
+    if shutil.which("pigz"):
+        return ["pigz", "-p", str(os.cpu_count() or 1)], "gz"
+    return ["gzip"], "gz"
+
+def pick_decompressor(ext):
+    """Return decompression argv for the given image extension."""
+    if ext == "zst":
+        return ["zstd", "-dc", "-T0"]
+    if shutil.which("pigz"):
+        return ["pigz", "-dc", "-p", str(os.cpu_count() or 1)]
+    return ["gzip", "-dc"]
+
+def with_ext(path, ext):
+    """Append .ext to path unless it already ends with it."""
+    return path if path.endswith(f".{ext}") else f"{path}.{ext}"
+
+def password_pipe(password):
+    """Return the read end of a pipe holding password, for openssl -pass fd:N."""
+    r, w = os.pipe()
+    os.write(w, password.encode() + b"\n")
+    os.close(w)
+    return r
+
+def _private_opener(path, flags):
+    """Create backup files readable by root only, they hold raw partition data."""
+    return os.open(path, flags, 0o600)
+
+def run_pipeline(stages, input_path=None, output_path=None, pass_fds=(), monitor=None, source=None,
+                 errors=None, prefix=None):
+    """Run argv stages connected by pipes, without a shell.
+
+    The first stage reads input_path and the last one writes output_path
+    when given. Instead of input_path, source may be a callable writing the
+    input into the file descriptor it receives; it runs in a background
+    thread. File descriptors from pass_fds are only inherited by the
+    stages referencing them as "fd:N". monitor is an optional
+    (stage_index, on_line) pair; stderr lines of that stage are passed to
+    on_line from a background thread. prefix is an optional (stage_index,
+    data) pair; data is put into the pipe feeding that stage ahead of its
+    input. Exceptions stopping the pipeline or
+    raised by source are appended to the errors list when given. Returns
+    True if every stage succeeded.
+    """
+    if errors is None:
+        errors = []
+    procs = []
+    watcher = None
+    feeder = None
+    feed_ok = [True]
+    src_w = None
+    if source is not None and not stages:
+        try:
+            with open(output_path, "wb", opener=_private_opener) as out:
+                source(out.fileno())
+        except Exception as e:
+            errors.append(e)
+            return False
+        return True
+    prev = None
+    out = None
+    try:
+        if source is not None:
+            src_r, src_w = os.pipe()
+            prev = os.fdopen(src_r, "rb")
+            if prefix is not None and prefix[0] == 0:
+                os.write(src_w, prefix[1])
+        elif input_path:
+            prev = open(input_path, "rb")
+        if output_path:
+            out = open(output_path, "wb", opener=_private_opener)
+        for i, argv in enumerate(stages):
+            last = i == len(stages) - 1
+            fds = tuple(fd for fd in pass_fds if f"fd:{fd}" in argv)
+            watched = monitor is not None and monitor[0] == i
+            stdout = out if last else subprocess.PIPE
+            nxt = None
+            if prefix is not None and prefix[0] == i + 1:
+                # A short prefix always fits the pipe buffer, the write cannot block
+                pipe_r, stdout = os.pipe()
+                nxt = os.fdopen(pipe_r, "rb")
+                os.write(stdout, prefix[1])
+            try:
+                proc = subprocess.Popen(argv, stdin=prev, stdout=stdout,
+                                        stderr=subprocess.PIPE if watched else None, pass_fds=fds)
+            except OSError:
+                if nxt is not None:
+                    nxt.close()
+                raise
+            finally:
+                if nxt is not None:
+                    os.close(stdout)
+            if watched:
+                watcher = threading.Thread(target=_watch_lines, args=(proc.stderr, monitor[1]), daemon=True)
+                watcher.start()
+            if prev is not None:
+                prev.close()
+            prev = proc.stdout if nxt is None else nxt
+            procs.append(proc)
+    except OSError as e:
+        errors.append(e)
+        if src_w is not None:
+            os.close(src_w)
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        return False
+    finally:
+        if prev is not None:
+            prev.close()
+        if out is not None:
+            out.close()
+    if source is not None:
+        def feed():
+            try:
+                source(src_w)
+            except Exception as e:
+                errors.append(e)
+                feed_ok[0] = False
+            finally:
+                os.close(src_w)
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+    ok = all([proc.wait() == 0 for proc in procs])
+    if feeder is not None:
+        feeder.join()
+    if watcher is not None:
+        watcher.join()
+    return ok and feed_ok[0]
+
+_LINE_END_RE = re.compile(rb"[\r\n]")
+
+def _watch_lines(stream, on_line):
+    """Pass every CR or LF terminated line of stream to on_line."""
+    pending = b""
+    while True:
+        chunk = os.read(stream.fileno(), 4096)
+        if not chunk:
+            break
+        *lines, pending = _LINE_END_RE.split(pending + chunk)
+        for line in lines:
+            if line:
+                on_line(line)
+    if pending:
+        on_line(pending)
+    stream.close()
+
+# dd status=progress line, e.g. "1073741824 bytes (1.1 GB, 1.0 GiB) copied, ..."
+_DD_PROGRESS_RE = re.compile(rb"(\d+) bytes")
+
+def gauge_updater(total):
+    """Return a callback moving the dialog gauge.
+
+    Accepts a byte count, pv -n output (plain percentage) or dd
+    status=progress lines with byte counts relative to total.
+    """
+    last = [-1]
+    def update(progress):
+        if isinstance(progress, int):
+            percent = progress * 100 // total
+        elif progress.strip().isdigit():
+            percent = int(progress)
+        else:
+            m = _DD_PROGRESS_RE.match(progress.strip())
+            if not m:
+                return
+            percent = int(m.group(1)) * 100 // total
+        percent = min(percent, 100)
+        if percent != last[0]:
+            last[0] = percent
+            d.gauge_update(percent)
+    return update
+
+# Largest single transfer requested from sendfile()/splice()
+SPLICE_CHUNK = 1 << 25
+
+# Read size used when the device does not advertise an optimal I/O size
+COPY_BUFFER_SIZE = 8 << 20
+
+@functools.lru_cache(maxsize=None)
+def optimal_bs(path):
+    """Return read block size for path based on the device optimal_io_size.
+
+    Partitions use the queue of their disk; device-mapper devices take the
+    largest value of their slaves. Falls back to COPY_BUFFER_SIZE.
+    """
+    sys_path = Path("/sys/class/block") / os.path.basename(os.path.realpath(path))
+    if (sys_path / "partition").exists():
+        sys_path = sys_path.resolve().parent
+    queues = [sys_path / "queue" / "optimal_io_size"]
+    queues += sorted((sys_path / "slaves").glob("*/queue/optimal_io_size"))
+    best = 0
+    for queue_file in queues:
+        try:
+            best = max(best, int(queue_file.read_text()))
+        except (OSError, ValueError):
+            continue
+    return max(best, 1 << 20) if best else COPY_BUFFER_SIZE
+
+@functools.lru_cache(maxsize=4)
+def _pbkdf2_key_iv(password, salt):
+    """Return the 48 bytes of key and IV openssl enc -pbkdf2 derives, once per password and salt."""
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS, 48)
+
+def _openssl_cipher(password, salt):
+    """Return the AES-256-CTR Cipher openssl enc -pbkdf2 derives from password and salt."""
+    key_iv = _pbkdf2_key_iv(password, salt)
+    return Cipher(algorithms.AES(key_iv[:32]), modes.CTR(key_iv[32:]))
+
+class _EncryptedWriter:
+    """File-like writer producing the openssl enc -aes-256-ctr -pbkdf2 format.
+
+    The key and IV are derived once and the cipher context is reused for
+    every chunk, so restore works with the openssl stage as before. The
+    plaintext starts with KEY_CHECK_BLOCK.
+    """
+    def __init__(self, fileobj, password):
+        salt = os.urandom(8)
+        self._encryptor = _openssl_cipher(password, salt).encryptor()
+        self._out = fileobj
+        self._out.write(OPENSSL_MAGIC + salt + self._encryptor.update(KEY_CHECK_BLOCK))
+
+    def write(self, data):
+        self._out.write(self._encryptor.update(data))
+        return len(data)
+
+    def flush(self):
+        self._out.flush()
+
+    def finalize(self):
+        self._out.write(self._encryptor.finalize())
+        self._out.flush()
+
+class _DecryptedWriter:
+    """File-like writer taking an openssl enc -aes-256-ctr -pbkdf2 stream.
+
+    The first 16 bytes (magic and salt) are collected before the key is
+    derived; everything after them is written to fileobj decrypted, except
+    the leading KEY_CHECK_BLOCK. ValueError is raised if it does not match.
+    """
+    def __init__(self, fileobj, password):
+        self._password = password
+        self._header = b""
+        self._check = b""
+        self._decryptor = None
+        self._out = fileobj
+
+    def write(self, data):
+        size = len(data)
+        if self._decryptor is None:
+            need = len(OPENSSL_MAGIC) + 8 - len(self._header)
+            self._header += bytes(data[:need])
+            data = data[need:]
+            if len(self._header) < len(OPENSSL_MAGIC) + 8:
+                return size
+            if not self._header.startswith(OPENSSL_MAGIC):
+                raise ValueError("not an openssl encrypted image")
+            self._decryptor = _openssl_cipher(self._password, self._header[len(OPENSSL_MAGIC):]).decryptor()
+        data = self._decryptor.update(data)
+        if len(self._check) < len(KEY_CHECK_BLOCK):
+            need = len(KEY_CHECK_BLOCK) - len(self._check)
+            self._check += data[:need]
+            data = data[need:]
+            if len(self._check) == len(KEY_CHECK_BLOCK) and self._check != KEY_CHECK_BLOCK:
+                raise ValueError("wrong password")
+        self._out.write(data)
+        return size
+
+    def finalize(self):
+        if len(self._check) < len(KEY_CHECK_BLOCK):
+            raise ValueError("truncated encrypted image")
+        self._out.write(self._decryptor.finalize())
+        self._out.flush()
+
+def check_password(path, password):
+    """Return True if password decrypts the KEY_CHECK_BLOCK at the start of path.
+
+    Only the header and the first block are read, so a wrong password is
+    caught before anything is written to the target.
+    """
+    header = len(OPENSSL_MAGIC) + 8
+    with open(path, "rb") as f:
+        head = f.read(header + len(KEY_CHECK_BLOCK))
+    if Cipher is not None:
+        check = _openssl_cipher(password, head[len(OPENSSL_MAGIC):header]).decryptor().update(head[header:])
     else:
-        return f"{bytes_size // (1 << 10)} KB"
+        pass_fd = password_pipe(password)
+        try:
+            check = subprocess.run(["openssl","enc","-d",CIPHER,"-pbkdf2","-iter",str(PBKDF2_ITERATIONS),
+                                    "-pass",f"fd:{pass_fd}"], input=head, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, pass_fds=(pass_fd,)).stdout
+        finally:
+            os.close(pass_fd)
+    return check == KEY_CHECK_BLOCK
 
-def list_devices():
-    """List all real storage devices."""
-    devices = []
-    found_devices = set()
-    # Method 1: lsblk -d
+def _parts_progress(on_progress, done):
+    """Return a progress callback for one part, counting the done bytes before it."""
+    return (lambda copied: on_progress(done + copied)) if on_progress else None
+
+def _unpack_parts_to(fd_out, parts, password=None, decompress=False, on_progress=None):
+    """Decrypt and/or zstd-decompress the concatenation of parts into fd_out in-process."""
+    with open(fd_out, "wb", closefd=False) as out:
+        sink = zstandard.ZstdDecompressor().stream_writer(out, closefd=False) if decompress else out
+        writer = _DecryptedWriter(sink, password) if password else sink
+        done = 0
+        for part in parts:
+            _copy_stream(part, writer, _parts_progress(on_progress, done))
+            done += os.path.getsize(part)
+        if password:
+            writer.finalize()
+        if decompress:
+            sink.close()
+
+def _drop_cache(fd, offset=0, length=0):
+    """Tell the kernel the given range of fd will not be needed again.
+
+    Keeps a whole-partition backup from evicting everybody else's page
+    cache. Dirty pages are queued for writeback and dropped on a later call.
+    """
     try:
-        output = subprocess.check_output(
-            "lsblk -d -o NAME,SIZE,MODEL,TYPE --noheadings",
-            shell=True, text=True
-        )
-        for line in output.strip().splitlines():
-            parts = line.split(None, 3)
-            if len(parts) >= 3:
-                name, size = parts[0], parts[1]
-                if name.startswith(('loop','ram','rom','dm-','sr')):
-                    continue
-                model = parts[2] if parts[2] != '-' else "Unknown model"
-                typ = parts[3] if len(parts) == 4 else "disk"
-                if typ == "disk" and name not in found_devices:
-                    devices.append((name, f"{size} | {model.strip()}"))
-                    found_devices.add(name)
-    except (subprocess.CalledProcessError, OSError):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except (OSError, AttributeError):
         pass
-    # Method 2: lsblk full
+
+def _mlock(buf, lock=True):
+    """Pin (or unpin) a writable buffer in RAM so the copy loop takes no page faults.
+
+    Best effort: silently does nothing when mlock() is not permitted.
+    """
     try:
-        output = subprocess.check_output(
-            "lsblk -o NAME,SIZE,MODEL,TYPE,PKNAME --noheadings",
-            shell=True, text=True
-        )
-        for line in output.strip().splitlines():
-            parts = line.split(None, 4)
-            if len(parts) >= 4:
-                name = parts[0].lstrip('├─└─│ ')
-                size = parts[1]
-                model = parts[2] if parts[2] != '-' else "Unknown model"
-                typ = parts[3]
-                pkname = parts[4] if len(parts) > 4 else ""
-                if typ == "disk" and not pkname and name not in found_devices:
-                    devices.append((name, f"{size} | {model.strip()}"))
-                    found_devices.add(name)
-    except (subprocess.CalledProcessError, OSError):
+        libc = ctypes.CDLL(None, use_errno=True)
+        addr = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+        (libc.mlock if lock else libc.munlock)(ctypes.c_void_p(addr), ctypes.c_size_t(len(buf)))
+    except (OSError, AttributeError, TypeError):
         pass
-    # Method 3: /proc/partitions
+
+# Reads kept in flight ahead of the compress/encrypt/write side
+READ_AHEAD_BUFFERS = 4
+
+def _read_ahead(fin, free, filled):
+    """Reader thread: fill buffers from free and hand them over through filled.
+
+    readinto() drops the GIL, so the next blocks are read while the caller
+    compresses, encrypts or writes the previous ones. None in free stops it.
+    """
+    try:
+        while True:
+            item = free.get()
+            if item is None:
+                return
+            n = fin.readinto(item[0])
+            filled.put((item, n))
+            if not n:
+                return
+    except OSError as e:
+        filled.put((None, e))
+
+def _open_direct(path):
+    """Open path for a one-pass sequential read that bypasses the page cache.
+
+    O_DIRECT is dropped where the filesystem refuses it and O_NOATIME where
+    we do not own the file; the kernel then at least gets the sequential hint.
+    """
+    flags = os.O_RDONLY | getattr(os, "O_DIRECT", 0) | getattr(os, "O_NOATIME", 0)
+    while True:
+        try:
+            fd = os.open(path, flags)
+            break
+        except OSError as e:
+            if e.errno == errno.EINVAL and flags & getattr(os, "O_DIRECT", 0):
+                flags &= ~os.O_DIRECT
+            elif e.errno == errno.EPERM and flags & getattr(os, "O_NOATIME", 0):
+                flags &= ~os.O_NOATIME
+            else:
+                raise
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (OSError, AttributeError):
+        pass
+    return fd
+
+def _copy_stream(part_path, writer, on_progress=None, block_size=None):
+    """Copy part_path into writer in block_size (default optimal_bs()) chunks.
+
+    A fixed pool of preallocated buffers is cycled between a reader thread
+    and this loop instead of allocating a new bytes object per block. The
+    buffers are anonymous mmaps, page aligned as O_DIRECT requires.
+    """
+    size = block_size or optimal_bs(part_path)
+    pool = [(buf, memoryview(buf)) for buf in (mmap.mmap(-1, size) for _ in range(READ_AHEAD_BUFFERS))]
+    free = queue.Queue()
+    filled = queue.Queue()
+    for item in pool:
+        _mlock(item[0])
+        free.put(item)
+    try:
+        with open(_open_direct(part_path), "rb", buffering=0) as fin:
+            reader = threading.Thread(target=_read_ahead, args=(fin, free, filled), daemon=True)
+            reader.start()
+            try:
+                copied = 0
+                while True:
+                    item, n = filled.get()
+                    if item is None:
+                        raise n
+                    if not n:
+                        break
+                    # Released even when write raises, the traceback would pin the mmap
+                    with item[1][:n] as chunk:
+                        writer.write(chunk)
+                    free.put(item)
+                    _drop_cache(fin.fileno(), copied, n)
+                    copied += n
+                    if on_progress:
+                        on_progress(copied)
+            finally:
+                free.put(None)
+                reader.join()
+    finally:
+        for buf, view in pool:
+            try:
+                view.release()
+                _mlock(buf, lock=False)
+                buf.close()
+            except BufferError:
+                pass  # still exported by the writer, freed with the last reference
+
+# Partitions larger than this are compressed by a pool of worker processes
+PARALLEL_MIN_SIZE = 100 << 30
+# Byte range compressed by one worker task into an independent zstd frame or gzip member
+PARALLEL_CHUNK = 32 << 20
+
+_worker_fd = None
+_worker_method = None
+
+def _open_worker_source(part_path, method):
+    """Pool initializer: open the partition once per worker process."""
+    global _worker_fd, _worker_method
+    _worker_fd = os.open(part_path, os.O_RDONLY)
+    _worker_method = method
+
+def _compress_range(offset, length):
+    """Pool worker: compress one byte range of the partition on its own."""
+    data = os.pread(_worker_fd, length, offset)
+    _drop_cache(_worker_fd, offset, length)
+    if _worker_method == "gzip":
+        comp = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+        return comp.compress(data) + comp.flush()
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+def _parallel_compress_to(writer, part_path, part_size, on_progress=None, workers=None, method="zstd"):
+    """Compress part_path with a pool of worker processes, one per core by default.
+
+    Each PARALLEL_CHUNK range becomes its own zstd frame or gzip member.
+    They are written in offset order and both formats decode a concatenation
+    as one stream, so restore needs nothing special and the result can still
+    be encrypted as a whole. At most two tasks per worker are in flight to
+    bound memory use.
+    """
+    workers = workers or os.cpu_count() or 1
+    ranges = ((off, min(PARALLEL_CHUNK, part_size - off)) for off in range(0, part_size, PARALLEL_CHUNK))
+    # Forked from the single-threaded fork server, not from us: workers inherit
+    # no pipe ends of concurrent pipelines and no locks held by other threads
+    with multiprocessing.get_context("forkserver").Pool(workers, _open_worker_source, (part_path, method)) as pool:
+        pending = collections.deque(
+            (off + length, pool.apply_async(_compress_range, (off, length)))
+            for off, length in itertools.islice(ranges, workers * 2)
+        )
+        while pending:
+            end, result = pending.popleft()
+            writer.write(result.get())
+            for off, length in itertools.islice(ranges, 1):
+                pending.append((off + length, pool.apply_async(_compress_range, (off, length))))
+            if on_progress:
+                on_progress(end)
+
+def _read_partition_to(fd_out, part_path, part_size=None, on_progress=None, compress=None, password=None,
+                       workers=None, block_size=None):
+    """Write part_path into fd_out, compressing and/or encrypting in-process.
+
+    compress is "zstd" or "gzip"; gzip is only done by the worker pool, for
+    partitions of at least PARALLEL_MIN_SIZE.
+    """
+    workers = workers or os.cpu_count() or 1
+    # Written pages of a regular output file are released as the copy goes
+    drop_output = stat.S_ISREG(os.fstat(fd_out).st_mode)
+    def progress(copied):
+        if drop_output:
+            _drop_cache(fd_out)
+        if on_progress:
+            on_progress(copied)
+    with open(fd_out, "wb", closefd=False) as out:
+        writer = _EncryptedWriter(out, password) if password else out
+        if compress and part_size and part_size >= PARALLEL_MIN_SIZE and workers > 1:
+            _parallel_compress_to(writer, part_path, part_size, progress, workers, compress)
+        elif compress:
+            cctx = zstandard.ZstdCompressor(compression_params=zstandard.ZstdCompressionParameters.from_level(
+                3, window_log=ZSTD_LONG_WINDOW, enable_ldm=True, threads=-1))
+            with cctx.stream_writer(writer, size=part_size or -1, closefd=False) as comp:
+                _copy_stream(part_path, comp, progress, block_size)
+        else:
+            _copy_stream(part_path, writer, progress, block_size)
+        if password:
+            writer.finalize()
+
+def _splice_partition_to(fd_out, part_path, part_size, on_progress=None, offset=0):
+    """Copy part_size bytes of part_path, from offset, into fd_out inside the kernel.
+
+    sendfile() is tried first; kernels refusing it for block devices fall
+    back to splice(), which moves pages through the pipe buffer. Neither
+    copies the data through Python.
+    """
+    fd_in = os.open(part_path, os.O_RDONLY)
+    try:
+        if offset:
+            os.lseek(fd_in, offset, os.SEEK_SET)
+        copied = 0
+        use_splice = False
+        while copied < part_size:
+            count = min(part_size - copied, SPLICE_CHUNK)
+            if use_splice:
+                n = os.splice(fd_in, fd_out, count, flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+            else:
+                try:
+                    n = os.sendfile(fd_out, fd_in, None, count)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    use_splice = True
+                    continue
+            if n == 0:
+                break
+            _drop_cache(fd_in, offset + copied, n)
+            copied += n
+            if on_progress:
+                on_progress(copied)
+    finally:
+        os.close(fd_in)
+    return copied
+
+# _IOR(0x12, 114, size_t): size of a block device in bytes
+BLKGETSIZE64 = 0x80081272
+
+def blockdev_size(path):
+    """Return the size of a block device or regular file in bytes, without forking.
+
+    st_size is 0 for block devices, so the BLKGETSIZE64 ioctl is used, with
+    seeking to the end as fallback for anything else. Raises OSError.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            return struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, bytes(8)))[0]
+        except OSError:
+            return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+def _copy_range_to(fd_out, part_path, part_size, on_progress=None):
+    """Copy part_size bytes of the regular file part_path into fd_out inside the kernel.
+
+    copy_file_range() never brings the data to userspace and clones extents
+    on filesystems with reflinks. Whatever it refuses (another filesystem)
+    is finished by _splice_partition_to. Only reached when --partition names
+    an image file, the interactive flow always picks a block device.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        fd_in = os.open(part_path, os.O_RDONLY)
+        try:
+            while copied < part_size:
+                try:
+                    n = os.copy_file_range(fd_in, fd_out, min(part_size - copied, SPLICE_CHUNK))
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+                    break
+                if n == 0:
+                    break
+                _drop_cache(fd_in, copied, n)
+                _drop_cache(fd_out)
+                copied += n
+                if on_progress:
+                    on_progress(copied)
+        finally:
+            os.close(fd_in)
+    if copied < part_size:
+        copied += _splice_partition_to(fd_out, part_path, part_size - copied,
+                                       _parts_progress(on_progress, copied), offset=copied)
+    return copied
+
+def get_size(path):
+    """Return size of a block device or regular file in bytes, or None."""
+    try:
+        return blockdev_size(path) or None
+    except OSError:
+        return None
+
+def dd_input_flags(path):
+    """Return dd iflag value for reading path, using O_DIRECT when supported.
+
+    Without O_DIRECT, nocache asks dd to drop the pages it has read.
+    """
+    try:
+        probe = spawn(["dd", f"if={path}", "of=/dev/null", f"bs={optimal_bs(path)}", "count=0", "iflag=direct"],
+                      stdout=subprocess.DEVNULL)
+    except OSError:
+        return "fullblock,nocache"
+    return "fullblock,direct" if probe.returncode == 0 else "fullblock,nocache"
+
+def dd_output_flags(path):
+    """Return dd oflag value for writing path, using O_DIRECT when supported."""
+    try:
+        probe = spawn(["dd", "if=/dev/zero", f"of={path}", "count=0", "oflag=direct", "conv=notrunc"],
+                      stdout=subprocess.DEVNULL)
+    except OSError:
+        return "nocache"
+    return "direct" if probe.returncode == 0 else "nocache"
+
+def parent_device(partition):
+    """Return /dev path of the disk holding partition, or "" if unknown."""
+    sys_path = Path("/sys/class/block") / os.path.basename(partition)
+    if not (sys_path / "partition").exists():
+        return ""
+    return "/dev/" + sys_path.resolve().parent.name
+
+_DIGITS_RE = re.compile(r"(\d+)")
+
+def natural_key(name):
+    """Sort key ordering embedded numbers numerically (sda2 before sda10)."""
+    return [int(part) if part.isdigit() else part for part in _DIGITS_RE.split(name)]
+
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    return shutil.which(name) or name
+
+def spawn(argv, stdout=subprocess.PIPE):
+    """Run a short-lived helper and wait for it, raising OSError if it is missing.
+
+    subprocess only takes the posix_spawn (vfork+exec) path for an absolute
+    executable with close_fds=False; our own descriptors are non-inheritable
+    by default (PEP 446), so nothing leaks into the helper.
+    """
+    return subprocess.run([_which(argv[0])] + argv[1:], stdout=stdout, stderr=subprocess.DEVNULL,
+                          close_fds=False, text=True)
+
+def run_output(argv):
+    """Return stripped stdout of argv, or an empty string if it fails."""
+    try:
+        result = spawn(argv)
+    except OSError:
+        return ""
+    return result.stdout.strip() if result.returncode == 0 else ""
+
+@functools.lru_cache(maxsize=1)
+def _lsblk_snapshot():
+    """Return the parsed block device tree from a single lsblk call."""
+    try:
+        return json.loads(run_output(["lsblk", "-J", "-b", "-o", "NAME,SIZE,MODEL,TYPE,FSTYPE,MOUNTPOINT"]))
+    except ValueError:
+        return {}
+
+# /proc/partitions line of a whole disk: major, minor, #blocks, name not ending in a digit
+_PROC_DISK_RE = re.compile(r"\s*\d+\s+\d+\s+(\d+)\s+(\S*[^\d\s])\s*$")
+
+def _sysfs_model(name):
+    """Return the model of disk name from sysfs, or "" if it has none."""
+    try:
+        return (Path("/sys/block") / name / "device" / "model").read_text().strip()
+    except OSError:
+        return ""
+
+@functools.lru_cache(maxsize=1)
+def list_devices():
+    """List all real storage devices as (name, description) pairs.
+
+    Cached: the backup and restore menus of one run show the same list.
+    """
+    devices = []
+    found_devices = set()
+    # Method 1: lsblk JSON snapshot
+    for dev in _lsblk_snapshot().get("blockdevices", []):
+        name = dev.get("name", "")
+        if dev.get("type") != "disk" or name.startswith(('loop','ram','rom','dm-','sr')):
+            continue
+        if name not in found_devices:
+            model = (dev.get("model") or "").strip() or "Unknown model"
+            devices.append((name, f"{format_size(dev.get('size'))} | {model}"))
+            found_devices.add(name)
+    if devices:
+        return tuple(devices)
+    # Method 2: /proc/partitions
     try:
         with open('/proc/partitions','r') as f:
+            _match = _PROC_DISK_RE.match
             for line in f:
-                parts = line.split()
-                if len(parts) >=4 and parts[3] and not any(c.isdigit() for c in parts[3][-1]):
-                    name = parts[3]
+                m = _match(line)
+                if m:
+                    name = m.group(2)
                     if name not in found_devices and name.startswith(('sd','nvme','vd','hd')):
-                        try:
-                            dev_path = f"/dev/{name}"
-                            size_bytes = int(subprocess.check_output(
-                                f"blockdev --getsize64 {dev_path}", shell=True, text=True
-                            ))
-                            size_str = format_size(size_bytes)
-                            try:
-                                model_output = subprocess.check_output(
-                                    f"lsblk -d -n -o MODEL {dev_path}", shell=True, text=True
-                                ).strip()
-                                model = model_output if model_output and model_output != '-' else "Unknown model"
-                            except:
-                                model = "Unknown model"
-                            devices.append((name, f"{size_str} | {model}"))
-                            found_devices.add(name)
-                        except:
-                            continue
+                        # #blocks is in KiB, the model comes from sysfs: no per-disk open or fork
+                        size_str = format_size(int(m.group(1)) << 10)
+                        model = _sysfs_model(name) or "Unknown model"
+                        devices.append((name, f"{size_str} | {model}"))
+                        found_devices.add(name)
     except Exception:
         pass
     # Fallback: scan /dev
     if not devices:
+        dev_paths = []
         for pattern in ["/dev/sd[a-z]","/dev/nvme*n*","/dev/vd[a-z]","/dev/hd[a-z]"]:
-            for dev_path in sorted(Path("/").glob(pattern.lstrip("/"))):
-                if dev_path.exists() and dev_path.name not in found_devices:
-                    try:
-                        size_bytes = int(subprocess.check_output(
-                            f"blockdev --getsize64 {dev_path}", shell=True, text=True
-                        ))
-                        size_str = format_size(size_bytes)
-                        devices.append((dev_path.name, f"{size_str} | Unknown model"))
-                    except:
-                        continue
-    return devices
+            dev_paths += glob.glob(pattern)
+        for dev_path in sorted(dev_paths, key=natural_key):
+            name = os.path.basename(dev_path)
+            if name not in found_devices:
+                try:
+                    size_bytes = blockdev_size(dev_path)
+                    size_str = format_size(size_bytes)
+                    devices.append((name, f"{size_str} | Unknown model"))
+                except:
+                    continue
+    return tuple(devices)
 
 # ===============================
 # Select functions
 # ===============================
 def select_device():
-    global DEVICE
     devices = list_devices()
     if not devices:
         d.msgbox("No storage devices found!", width=70)
@@ -194,10 +981,9 @@ def select_device():
     code, tag = d.menu("Select storage device:", choices=choices, width=70, height=15)
     if code != d.DIALOG_OK:
         sys.exit(0)
-    DEVICE = "/dev/" + tag if not tag.startswith("/dev/") else tag
+    return "/dev/" + tag if not tag.startswith("/dev/") else tag
 
 def select_restore_device():
-    global RESTORE_DEVICE
     devices = list_devices()
     if not devices:
         d.msgbox("No storage devices found!", width=70)
@@ -206,163 +992,489 @@ def select_restore_device():
     code, tag = d.menu("Select destination device for restore:", choices=choices, width=70, height=15)
     if code != d.DIALOG_OK:
         sys.exit(0)
-    RESTORE_DEVICE = "/dev/" + tag if not tag.startswith("/dev/") else tag
+    return "/dev/" + tag if not tag.startswith("/dev/") else tag
 
 # ===============================
 # Partition functions
 # ===============================
-def list_partitions(device):
-    partitions = []
+def _blkid_types(paths):
+    """Return {path: filesystem type} for paths from a single blkid call."""
+    types = {}
+    name = None
+    for line in run_output(["blkid", "-o", "export"] + list(paths)).splitlines():
+        key, _, value = line.partition("=")
+        if key == "DEVNAME":
+            name = value
+        elif key == "TYPE" and name:
+            types[name] = value
+    return types
+
+# Octal escape of a space, tab, newline or backslash in /proc/self/mounts, e.g. \040
+_OCTAL_ESCAPE_RE = re.compile(r"\\([0-7]{3})")
+
+def _mount_points():
+    """Return {source device: mount point} read from /proc/self/mounts."""
+    mounts = {}
     try:
-        output = subprocess.check_output(
-            f"lsblk -n -r {device} -o NAME,SIZE,FSTYPE,MOUNTPOINT", shell=True, text=True
-        )
-        for line in output.strip().splitlines():
-            parts = line.split(None,3)
-            if len(parts)<2: continue
-            name,size = parts[0], parts[1]
-            fstype = parts[2] if len(parts)>2 else "unknown"
-            mount = parts[3] if len(parts)>3 else "not mounted"
-            if os.path.basename(device)!=os.path.basename(name):
-                partitions.append((os.path.basename(name), f"{size} | {fstype} | {mount}"))
-    except:
+        with open("/proc/self/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0].startswith("/dev/"):
+                    target = _OCTAL_ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 8)), fields[1])
+                    mounts.setdefault(fields[0], target)
+    except OSError:
         pass
-    if not partitions:
-        base=os.path.basename(device)
-        for part_file in sorted(list(glob.glob(f"/dev/{base}[0-9]*"))+list(glob.glob(f"/dev/{base}p[0-9]*"))):
-            if os.path.exists(part_file):
-                try:
-                    size_bytes=int(subprocess.check_output(f"blockdev --getsize64 {part_file}", shell=True, text=True))
-                    size_str=format_size(size_bytes)
-                except:
-                    size_str="Unknown size"
-                fstype=subprocess.getoutput(f"blkid -o value -s TYPE {part_file}") or "unknown"
-                mount=subprocess.getoutput(f"findmnt -n -o TARGET {part_file}") or "not mounted"
-                partitions.append((os.path.basename(part_file), f"{size_str} | {fstype} | {mount}"))
-    return partitions
+    return mounts
 
-def select_partition():
-    global PARTITION
-    partitions=list_partitions(DEVICE)
+def list_partitions(device):
+    partitions = []
+    base = os.path.basename(device)
+    disk = next((dev for dev in _lsblk_snapshot().get("blockdevices", []) if dev.get("name") == base), None)
+    if disk is None:
+        # Not in the snapshot (e.g. plugged in since), ask lsblk about this disk only
+        try:
+            disk = (json.loads(run_output(["lsblk", "-J", "-b", "-o", "NAME,SIZE,FSTYPE,MOUNTPOINT", device]))
+                    .get("blockdevices") or [None])[0]
+        except ValueError:
+            disk = None
+    for part in (disk or {}).get("children", []):
+        fstype = part.get("fstype") or "unknown"
+        mount = part.get("mountpoint") or "not mounted"
+        partitions.append((part["name"], f"{format_size(part.get('size'))} | {fstype} | {mount}"))
     if not partitions:
-        d.msgbox(f"No partitions found on device {DEVICE}!", width=70)
-        sys.exit(1)
-    choices=[(name,desc) for name,desc in partitions]
-    code, tag = d.menu(f"Select partition on {DEVICE}:", choices=choices, width=70, height=15)
-    if code!=d.DIALOG_OK:
-        sys.exit(0)
-    PARTITION="/dev/"+tag if not tag.startswith("/dev/") else tag
+        part_files = sorted(glob.glob(f"/dev/{base}[0-9]*")+glob.glob(f"/dev/{base}p[0-9]*"), key=natural_key)
+        types = _blkid_types(part_files) if part_files else {}
+        mounts = _mount_points()
+        for part_file in part_files:
+            try:
+                size_bytes=blockdev_size(part_file)
+                size_str=format_size(size_bytes)
+            except:
+                size_str="Unknown size"
+            fstype=types.get(part_file) or "unknown"
+            mount=mounts.get(part_file) or "not mounted"
+            partitions.append((os.path.basename(part_file), f"{size_str} | {fstype} | {mount}"))
+    return partitions
 
-def select_restore_partition():
-    global RESTORE_PARTITION
-    partitions=list_partitions(RESTORE_DEVICE)
+def select_partition(device):
+    partitions=list_partitions(device)
     if not partitions:
-        d.msgbox(f"No partitions found on device {RESTORE_DEVICE}!", width=70)
+        d.msgbox(f"No partitions found on device {device}!", width=70)
         sys.exit(1)
     choices=[(name,desc) for name,desc in partitions]
-    code, tag = d.menu(f"Select partition on {RESTORE_DEVICE}:", choices=choices, width=70, height=15)
+    code, tag = d.menu(f"Select partition on {device}:", choices=choices, width=70, height=15)
     if code!=d.DIALOG_OK:
         sys.exit(0)
-    RESTORE_PARTITION="/dev/"+tag if not tag.startswith("/dev/") else tag
+    return "/dev/"+tag if not tag.startswith("/dev/") else tag
 
 def select_output_path():
-    global OUTPUT_PATH
     code, path = d.fselect("/", width=70, height=20)
     if code != d.DIALOG_OK:
         sys.exit(0)
-    OUTPUT_PATH=path
+    return path
 
 def select_restore_file():
-    global RESTORE_FILE
     code, path=d.fselect("/", width=70, height=20)
     if code!=d.DIALOG_OK:
         sys.exit(0)
-    RESTORE_FILE=path
+    return path
 
 def select_encryption():
-    global ENCRYPT, ENCRYPT_PASSWORD
-    code = d.yesno("Do you want to encrypt the backup? (LUKS)", width=70)
-    if code==d.DIALOG_OK:
-        ENCRYPT=True
+    """Return (encrypt, password)."""
+    code = d.yesno("Do you want to encrypt the backup? (AES-256)", width=70)
+    if code!=d.DIALOG_OK:
+        return False, ""
+    while True:
         code, pwd = d.passwordbox("Enter encryption password:", width=70)
-        if code==d.DIALOG_OK:
-            ENCRYPT_PASSWORD=pwd
-        else:
+        if code!=d.DIALOG_OK:
             sys.exit(0)
+        code, again = d.passwordbox("Confirm encryption password:", width=70)
+        if code!=d.DIALOG_OK:
+            sys.exit(0)
+        if pwd==again:
+            return True, pwd
+        d.msgbox("Passwords do not match, try again.", width=70)
 
 def select_compression():
-    global COMPRESS
-    code=d.yesno("Do you want to compress the backup? (gzip)", width=70)
-    if code==d.DIALOG_OK:
-        COMPRESS=True
-
-def show_backup_summary():
-    summary=f"Device: {DEVICE}\nPartition: {PARTITION}\nOutput path: {OUTPUT_PATH}\n"
-    summary+=f"Encryption: {'Yes' if ENCRYPT else 'No'}\nCompression: {'Yes' if COMPRESS else 'No'}\n"
+    """Return (compress, method)."""
+    code=d.yesno("Do you want to compress the backup?", width=70)
+    if code!=d.DIALOG_OK:
+        return False, "zstd"
+    code, tag = d.radiolist("Select compression method:", choices=[
+        ("zstd", "fast (zstd)", True),
+        ("gzip", "compatible (gzip)", False),
+    ], width=70, height=12)
+    if code!=d.DIALOG_OK:
+        sys.exit(0)
+    return True, tag
+
+def select_split(partition):
+    """Return (size as typed, size in bytes), ("", 0) when not splitting."""
+    code=d.yesno("Do you want to split the backup into smaller files?", width=70)
+    if code!=d.DIALOG_OK:
+        return "", 0
+    total=get_size(partition)
+    while True:
+        code, size=d.inputbox("Enter part size (e.g. 4G, 500M, .5G):", init="4G", width=70)
+        if code!=d.DIALOG_OK:
+            sys.exit(0)
+        try:
+            parsed=parse_size(size)
+        except ValueError as e:
+            d.msgbox(str(e), width=70)
+            continue
+        parts=-(-total // parsed) if total else 0
+        if parts>MAX_SPLIT_PARTS and d.yesno(f"This will create up to {parts} files; continue?", width=70)!=d.DIALOG_OK:
+            continue
+        break
+    return size.strip(), parsed
+
+def backup_summary(cfg):
+    summary=f"Device: {cfg.device}\nPartition: {cfg.partition}\nOutput path: {cfg.output}\n"
+    summary+=f"Encryption: {'Yes' if cfg.encrypt else 'No'}\nCompression: {cfg.compress_method if cfg.compress else 'No'}\n"
+    summary+=f"Split: {cfg.split_size if cfg.split_bytes else 'No'}\n"
     try:
-        partition_size=int(subprocess.check_output(f"blockdev --getsize64 {PARTITION}", shell=True, text=True))
-        available=shutil.disk_usage(os.path.dirname(OUTPUT_PATH)).free
+        partition_size=get_size(cfg.partition)
+        available=shutil.disk_usage(os.path.dirname(cfg.output)).free
         if partition_size>available:
             summary+="\nWARNING: Partition size exceeds available disk space!"
     except:
         pass
-    d.msgbox(summary,width=70)
+    return summary
+
+def show_backup_summary(cfg):
+    d.msgbox(backup_summary(cfg),width=70)
+
+# First part of a split image, e.g. backup.img.gz.aa
+_FIRST_PART_RE = re.compile(r"(.+)\.(a{2,})")
+
+@functools.lru_cache(maxsize=8)
+def _list_parts(base_dir, prefix):
+    """Return the names of the regular files in base_dir starting with prefix.
+
+    One scandir() pass; its dirent type information spares a stat() per entry.
+    """
+    with os.scandir(base_dir) as entries:
+        return frozenset(e.name for e in entries if e.name.startswith(prefix) and e.is_file())
+
+def detect_file_properties(path):
+    """Detect restore image properties from its content and name.
 
-def show_restore_summary():
-    summary=f"Restore file: {RESTORE_FILE}\nDevice: {RESTORE_DEVICE}\nPartition: {RESTORE_PARTITION}\n"
-    summary+=f"Encrypted: {'Yes' if IS_ENCRYPTED else 'No'}\nCompressed: {'Yes' if IS_COMPRESSED else 'No'}\n"
+    Returns (encrypted, decompressor argv, split parts) for RestoreConfig.
+    """
+    name = path
+    parts = ()
+    m = _FIRST_PART_RE.fullmatch(path)
+    if m:
+        base_dir, stem = os.path.split(m.group(1))
+        prefix = stem + "."
+        try:
+            found = _list_parts(base_dir or ".", prefix)
+        except OSError:
+            found = frozenset()
+        # Parts in split's order up to the first gap, other files sharing the prefix are not parts
+        parts = []
+        for letters in itertools.product(string.ascii_lowercase, repeat=len(m.group(2))):
+            part = prefix + "".join(letters)
+            if part not in found:
+                break
+            parts.append(os.path.join(base_dir, part))
+        parts = tuple(parts)
+        if parts:
+            name = m.group(1)
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(8)
+    except OSError:
+        return False, (), parts
+    encrypted = magic.startswith(OPENSSL_MAGIC)
+    if name.endswith(".enc"):
+        name = name[:-len(".enc")]
+    if magic.startswith(ZSTD_MAGIC) or name.endswith(".zst"):
+        ext = "zst"
+    elif magic.startswith(GZIP_MAGIC) or name.endswith(".gz"):
+        ext = "gz"
+    else:
+        return encrypted, (), parts
+    return encrypted, tuple(pick_decompressor(ext)), parts
+
+def select_restore_password():
+    code, pwd = d.passwordbox("Enter decryption password:", width=70)
+    if code!=d.DIALOG_OK:
+        sys.exit(0)
+    return pwd
+
+def show_restore_summary(cfg):
+    summary=f"Restore file: {cfg.file}\nDevice: {cfg.device}\nPartition: {cfg.partition}\n"
+    summary+=f"Encrypted: {'Yes' if cfg.encrypted else 'No'}\nCompressed: {'Yes' if cfg.decompressor else 'No'}\n"
+    summary+=f"Split: {f'Yes ({len(cfg.parts)} parts)' if cfg.parts else 'No'}\n"
     d.msgbox(summary,width=70)
 
 # ===============================
 # Backup & Restore functions
 # ===============================
-def create_image():
-    cmd=["dd","if="+PARTITION,"of="+OUTPUT_PATH,"bs=4M","status=progress"]
-    if COMPRESS:
-        cmd=["bash","-c",f"dd if={PARTITION} bs=4M status=progress | gzip > {OUTPUT_PATH}"]
-    if ENCRYPT:
-        cmd=["bash","-c",f"dd if={PARTITION} bs=4M status=progress | cryptsetup luksFormat -q - {OUTPUT_PATH}.luks && dd if={PARTITION} bs=4M status=progress | cryptsetup luksOpen {OUTPUT_PATH}.luks backup && dd if={PARTITION} of=/dev/mapper/backup"]
+def create_image(cfg):
+    """Back up cfg.partition, return True on success."""
+    size=get_size(cfg.partition)
+    output=cfg.output
+    stages=[]
+    pass_fd=None
+    enc_stage=None
+    workers=cfg.workers or os.cpu_count() or 1
+    parallel=bool(size) and size>=PARALLEL_MIN_SIZE and workers>1
+    # gzip is only compressed in-process by the worker pool, pigz does it otherwise
+    compress_in_process=cfg.compress and (zstandard is not None if cfg.compress_method=="zstd" else parallel)
+    # In-process encryption needs Python to produce the stream it encrypts
+    encrypt_in_process=cfg.encrypt and Cipher is not None and (compress_in_process or not cfg.compress)
+    if compress_in_process:
+        output=with_ext(output, "zst" if cfg.compress_method=="zstd" else "gz")
+    elif cfg.compress:
+        comp_cmd, ext = pick_compressor(cfg.compress_method)
+        stages.append(comp_cmd)
+        output=with_ext(output, ext)
+    if encrypt_in_process:
+        output=with_ext(output, "enc")
+    elif cfg.encrypt:
+        pass_fd=password_pipe(cfg.password)
+        enc_stage=["openssl","enc",CIPHER,"-pbkdf2","-iter",str(PBKDF2_ITERATIONS),"-salt","-pass",f"fd:{pass_fd}"]
+        stages.append(enc_stage)
+        output=with_ext(output, "enc")
+    if cfg.split_bytes:
+        suffix=split_suffix_length(image_size_bound(size, cfg.compress, cfg.encrypt), cfg.split_bytes)
+        stages.append(["split","-b",str(cfg.split_bytes),"-a",str(suffix),"-",output+"."])
+        output=None
+    gauge=gauge_updater(size) if size and INTERACTIVE else None
+    source=None
+    monitor=None
+    if compress_in_process or encrypt_in_process:
+        # Compress/encrypt while reading, the remaining stages get the result
+        source=lambda fd_out: _read_partition_to(fd_out, cfg.partition, size, gauge,
+                                                 compress=cfg.compress_method if compress_in_process else None,
+                                                 password=cfg.password if encrypt_in_process else None, workers=workers,
+                                                 block_size=cfg.block_size or None)
+    elif stages and size and hasattr(os, "splice"):
+        # Feed the first stage straight from the partition, without dd
+        source=lambda fd_out: _splice_partition_to(fd_out, cfg.partition, size, gauge)
+        if not INTERACTIVE and shutil.which("pv"):
+            stages.insert(0, ["pv","-s",str(size)])
+    elif not stages and size and stat.S_ISREG(os.stat(cfg.partition).st_mode):
+        # Plain image of a file, copied inside the kernel; dd conv=sparse below keeps device images sparse
+        source=lambda fd_out: _copy_range_to(fd_out, cfg.partition, size, gauge)
+    else:
+        dd_in=["dd",f"if={cfg.partition}",f"bs={cfg.block_size or optimal_bs(cfg.partition)}",
+               f"iflag={dd_input_flags(cfg.partition)}"]
+        if stages and size and shutil.which("pv"):
+            stages.insert(0, ["pv","-n","-s",str(size)] if INTERACTIVE else ["pv","-s",str(size)])
+            if gauge:
+                monitor=(1, gauge)
+        else:
+            dd_in.append("status=progress")
+            if gauge:
+                monitor=(0, gauge)
+        if not stages:
+            dd_in+=[f"of={output}","conv=sparse","oflag=nocache"]
+            output=None
+        stages.insert(0, dd_in)
+    if gauge:
+        d.gauge_start(f"Creating backup of {cfg.partition}...", width=70, percent=0)
+    elif INTERACTIVE:
+        d.infobox(f"Creating backup of {cfg.partition}, this may take a long time...", width=70)
+    errors=[]
     try:
-        subprocess.check_call(cmd)
-        d.msgbox("Backup finished successfully!",width=70)
-    except subprocess.CalledProcessError:
-        d.msgbox("ERROR: Backup failed!",width=70)
-        sys.exit(1)
+        ok=run_pipeline(stages, output_path=output, pass_fds=(pass_fd,) if pass_fd is not None else (),
+                        monitor=monitor, source=source, errors=errors,
+                        prefix=(stages.index(enc_stage), KEY_CHECK_BLOCK) if enc_stage else None)
+    finally:
+        if pass_fd is not None:
+            os.close(pass_fd)
+        if gauge:
+            d.gauge_stop()
+    if ok:
+        notify(f"Backup of {cfg.partition} finished successfully!")
+    else:
+        notify(f"ERROR: Backup of {cfg.partition} failed!" + "".join(f"\n{e}" for e in errors))
+    return ok
 
-def restore_image():
-    cmd=["dd","if="+RESTORE_FILE,"of="+RESTORE_PARTITION,"bs=4M","status=progress"]
-    if IS_COMPRESSED:
-        cmd=["bash","-c",f"gzip -dc {RESTORE_FILE} | dd of={RESTORE_PARTITION} bs=4M status=progress"]
-    if IS_ENCRYPTED:
-        cmd=["bash","-c",f"cryptsetup luksOpen {RESTORE_FILE} backup && dd if=/dev/mapper/backup of={RESTORE_PARTITION} bs=4M status=progress"]
+def restore_image(cfg):
+    """Write cfg.file back to cfg.partition, return True on success."""
+    # fullblock keeps pipe reads at bs, as O_DIRECT writes need whole blocks
+    dd_out=["dd",f"of={cfg.partition}",f"bs={optimal_bs(cfg.partition)}","iflag=fullblock",
+            f"oflag={dd_output_flags(cfg.partition)}"]
+    stages=[]
+    pass_fd=None
+    source=None
+    monitor=None
+    # Progress is measured on the image side, the restored size is unknown when compressed
     try:
-        subprocess.check_call(cmd)
-        d.msgbox("Restore finished successfully!",width=70)
-    except subprocess.CalledProcessError:
-        d.msgbox("ERROR: Restore failed!",width=70)
-        sys.exit(1)
+        total=sum(os.path.getsize(part) for part in cfg.parts or (cfg.file,))
+        # Checked up front, dd would otherwise write garbage over the partition
+        if cfg.encrypted and not check_password((cfg.parts or (cfg.file,))[0], cfg.password):
+            notify("ERROR: Wrong password!")
+            return False
+    except OSError as e:
+        notify(f"ERROR: Restore failed!\n{e}")
+        return False
+    gauge=gauge_updater(total) if total and INTERACTIVE else None
+    decrypt_in_process=cfg.encrypted and Cipher is not None
+    # The zstd process decompresses on its own core, libzstd in-process only stands in for a missing CLI
+    decompress_in_process=(cfg.decompressor[:1]==("zstd",) and zstandard is not None and not shutil.which("zstd")
+                           and (decrypt_in_process or not cfg.encrypted))
+    if cfg.encrypted and not decrypt_in_process:
+        pass_fd=password_pipe(cfg.password)
+        stages.append(["openssl","enc","-d",CIPHER,"-pbkdf2","-iter",str(PBKDF2_ITERATIONS),"-pass",f"fd:{pass_fd}"])
+        stages.append(["tail","-c",f"+{len(KEY_CHECK_BLOCK) + 1}"])
+    if cfg.decompressor and not decompress_in_process:
+        stages.append(list(cfg.decompressor))
+    stages.append(dd_out)
+    if decrypt_in_process or decompress_in_process:
+        # Unpack while reading, the decompressor or dd gets the result
+        source=lambda fd_out: _unpack_parts_to(fd_out, cfg.parts or (cfg.file,),
+                                               cfg.password if decrypt_in_process else None,
+                                               decompress_in_process, gauge)
+    elif cfg.parts or len(stages)>1:
+        # Feed the parts, or the single image, into the first stage, counting bytes for the gauge
+        def source(fd_out):
+            done=0
+            for part in cfg.parts or (cfg.file,):
+                size=os.path.getsize(part)
+                _splice_partition_to(fd_out, part, size, _parts_progress(gauge, done))
+                done+=size
+    else:
+        dd_out.insert(1, f"if={cfg.file}")
+        dd_out.append("status=progress")
+        if gauge:
+            monitor=(0, gauge)
+    if not INTERACTIVE and "status=progress" not in dd_out:
+        dd_out.append("status=progress")
+    if gauge and (source is not None or monitor):
+        d.gauge_start(f"Restoring {cfg.partition}...", width=70, percent=0)
+    else:
+        gauge=None
+        if INTERACTIVE:
+            d.infobox(f"Restoring {cfg.partition}, this may take a long time...", width=70)
+    errors=[]
+    try:
+        ok=run_pipeline(stages, pass_fds=(pass_fd,) if pass_fd is not None else (), monitor=monitor,
+                        source=source, errors=errors)
+    finally:
+        if pass_fd is not None:
+            os.close(pass_fd)
+        if gauge:
+            d.gauge_stop()
+    if ok:
+        notify("Restore finished successfully!")
+    else:
+        notify("ERROR: Restore failed!" + "".join(f"\n{e}" for e in errors))
+    return ok
 
 # ===============================
 # Main workflow
 # ===============================
 def backup_workflow():
-    select_device()
-    select_partition()
-    select_output_path()
-    select_encryption()
-    select_compression()
-    show_backup_summary()
-    create_image()
+    device=select_device()
+    partition=select_partition(device)
+    output=select_output_path()
+    encrypt, password=select_encryption()
+    compress, method=select_compression()
+    split_size, split_bytes=select_split(partition)
+    cfg=BackupConfig(device, partition, output, encrypt, password, compress, method, split_size, split_bytes)
+    show_backup_summary(cfg)
+    if not create_image(cfg):
+        sys.exit(1)
 
 def restore_workflow():
-    select_restore_file()
-    select_restore_device()
-    select_restore_partition()
-    # Detect properties from file if needed
-    show_restore_summary()
-    restore_image()
+    path=select_restore_file()
+    device=select_restore_device()
+    partition=select_partition(device)
+    encrypted, decompressor, parts=detect_file_properties(path)
+    password=""
+    if encrypted:
+        password=select_restore_password()
+        while not check_password((parts or (path,))[0], password):
+            d.msgbox("Wrong password, try again.", width=70)
+            password=select_restore_password()
+    cfg=RestoreConfig(path, device, partition, encrypted, password, decompressor, parts)
+    show_restore_summary(cfg)
+    if not restore_image(cfg):
+        sys.exit(1)
+
+def batch_backup(args):
+    """Run backups configured entirely from command line arguments.
+
+    Several --partition options are backed up concurrently into the --output
+    directory, the work is I/O-bound and threads wait on subprocesses.
+    """
+    global INTERACTIVE
+    INTERACTIVE=False
+    password=""
+    if args.encrypt_pass_file:
+        # Read from a file so the password never shows up in /proc/*/cmdline
+        password=Path(args.encrypt_pass_file).read_text(encoding="utf-8").strip()
+    split_bytes=0
+    if args.split_size:
+        try:
+            split_bytes=parse_size(args.split_size)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+    cfgs=[]
+    for partition in args.partition:
+        output=args.output
+        if len(args.partition)>1:
+            output=os.path.join(args.output, os.path.basename(partition)+".img")
+        cfgs.append(BackupConfig(parent_device(partition), partition, output, bool(args.encrypt_pass_file),
+                                 password, bool(args.compress), args.compress or "zstd",
+                                 args.split_size or "", split_bytes, args.parallel, args.bs))
+    print("\n".join(backup_summary(cfg) for cfg in cfgs))
+    if not args.yes and input("Continue? [y/N] ").strip().lower() not in ("y", "yes"):
+        sys.exit(0)
+    with ThreadPoolExecutor(max_workers=len(cfgs)) as ex:
+        results=list(ex.map(create_image, cfgs))
+    if not all(results):
+        sys.exit(1)
+
+def parse_args():
+    parser=argparse.ArgumentParser(
+        description="Partition backup creator/restorer. Without --partition an interactive dialog is shown."
+    )
+    parser.add_argument("--partition", action="append",
+                        help="partition to back up, e.g. /dev/sda1 (enables non-interactive mode); "
+                             "repeat to back up several partitions in parallel")
+    parser.add_argument("--output", help="output image path, extensions are appended automatically; "
+                                         "a directory when --partition is repeated")
+    parser.add_argument("--compress", choices=["zstd","gzip"], help="compress the image with the given method")
+    parser.add_argument("--encrypt-pass-file", metavar="FILE", help="encrypt the image with the password stored in FILE")
+    parser.add_argument("--split-size", metavar="SIZE", help="split the image into parts of SIZE, e.g. 4G")
+    parser.add_argument("--parallel", metavar="N", type=int, default=0,
+                        help="compression processes for partitions over 100 GiB (default: one per core, 1 disables)")
+    parser.add_argument("--bs", metavar="SIZE",
+                        help="read block size, e.g. 16M (default: the device optimal I/O size, or 8M)")
+    parser.add_argument("--yes", action="store_true", help="do not ask for confirmation")
+    args=parser.parse_args()
+    if args.partition and not args.output:
+        parser.error("--output is required with --partition")
+    if args.partition and len(args.partition)>1 and not os.path.isdir(args.output):
+        parser.error("--output must be an existing directory when --partition is repeated")
+    if args.parallel<0:
+        parser.error("--parallel must not be negative")
+    try:
+        args.bs=parse_size(args.bs) if args.bs else 0
+    except ValueError as e:
+        parser.error(f"--bs: {e}")
+    if args.bs%4096:
+        # O_DIRECT reads need whole blocks
+        parser.error("--bs must be a multiple of 4K")
+    return args
 
 def main():
+    global d
+    d = dialog.Dialog(dialog="dialog")
+    # Inherited by split and dd, so every part they create is root-only like _private_opener's files
+    os.umask(0o077)
+    args=parse_args()
+    if args.partition:
+        batch_backup(args)
+        return
     code, tag=d.menu("Select operation:", choices=[("backup","Create partition backup"),("restore","Restore from backup")], width=70, height=10)
     if code!=d.DIALOG_OK:
         sys.exit(0)